@@ -5,17 +5,24 @@ Gemini APIを使用してECサイトから商品情報を抽出し、Cloudflare
 """
 
 import os
-import json
 import asyncio
 import logging
-from datetime import datetime
-from typing import List, Dict, Optional
+import argparse
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from collections import OrderedDict
+from typing import List, Dict, Final, Optional, Tuple
 import hashlib
+from functools import lru_cache
 
 import google.generativeai as genai
-import requests
+from google.generativeai.types import generation_types
+import aiohttp
+import orjson
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
-from pydantic import BaseModel, Field
+import msgspec
+from typing_extensions import TypedDict, NotRequired
 
 # 環境変数の読み込み
 load_dotenv()
@@ -27,7 +34,76 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-class Product(BaseModel):
+# Geminiのモデル名とプロンプトのバージョン（キャッシュキーに使用）
+GEMINI_MODEL_NAME = 'gemini-1.5-flash'
+PROMPT_VERSION = 'v2'
+
+# Gemini APIのレート制限対策（同時呼び出し数の上限と1分あたりのリクエスト数）
+GEMINI_CONCURRENCY = 8
+GEMINI_REQUESTS_PER_MINUTE = 60
+
+# 抽出結果キャッシュの既定の有効期間（価格が古くならないよう短めにする）
+EXTRACTION_CACHE_TTL = timedelta(minutes=30)
+
+# プロセス内に保持する抽出結果の最大件数（サイト名・URLの組ごと）
+MEMORY_CACHE_SIZE = 256
+
+# Geminiの出力がスキーマに適合しない場合に、エラー内容を付けて再試行する回数
+MAX_FEEDBACK_RETRIES = 2
+
+# D1 APIへのリクエストを再試行するステータスコード・回数・バックオフ係数（秒）
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_HTTP_RETRIES = 3
+RETRY_BACKOFF_FACTOR = 1.0
+
+# 1回のバッチリクエストでアップサートする商品数の上限
+UPSERT_BATCH_SIZE = 25
+
+# 商品情報のアップサート文
+_UPSERT_SQL: Final[str] = """
+INSERT INTO products (
+    id, name, price, product_url, affiliate_url, 
+    image_url, site_name, last_scraped_at, created_at, updated_at
+) VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+ON CONFLICT(id) DO UPDATE SET
+    name = excluded.name,
+    price = excluded.price,
+    affiliate_url = excluded.affiliate_url,
+    image_url = excluded.image_url,
+    last_scraped_at = CURRENT_TIMESTAMP,
+    updated_at = CURRENT_TIMESTAMP
+"""
+
+# 商品情報抽出用の静的なプロンプト（URLは末尾に付加する）
+EXTRACTION_PROMPT = """
+以下のECサイトのURLから、お米の商品情報を抽出してください。
+URLはこの指示の末尾に記載します。
+
+各商品について以下の情報をJSON形式で抽出してください：
+- name: 商品名（お米の銘柄、容量など）
+- price: 価格（数値のみ、円単位）
+- product_url: 商品詳細ページのURL
+- image_url: 商品画像のURL
+
+出力形式：
+{
+    "products": [
+        {
+            "name": "商品名",
+            "price": 価格（数値）,
+            "product_url": "URL",
+            "image_url": "画像URL"
+        }
+    ]
+}
+
+注意事項：
+- お米以外の商品は除外してください
+- 価格は税込み価格を抽出してください
+- URLは完全な形式（https://から始まる）で抽出してください
+"""
+
+class Product(msgspec.Struct, frozen=True, gc=False, kw_only=True):
     """商品情報のモデル"""
     id: str
     name: str
@@ -37,84 +113,220 @@ class Product(BaseModel):
     image_url: Optional[str] = None
     site_name: str
 
+class ExtractedProduct(TypedDict):
+    """Geminiが返す商品情報（構造化出力のスキーマ）"""
+    name: str
+    price: int
+    product_url: str
+    image_url: NotRequired[Optional[str]]
+
+class ProductsList(TypedDict):
+    """Geminiが返す商品一覧（構造化出力のスキーマ）"""
+    products: List[ExtractedProduct]
+
+# JSONでの構造化出力を強制する生成設定
+GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": ProductsList
+}
+
 class GeminiScraper:
     """Gemini APIを使用したスクレイパー"""
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, cache_dir: Optional[str] = None,
+                 cache_ttl: timedelta = EXTRACTION_CACHE_TTL):
         genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+        # スキーマが不正な場合、各呼び出しで失敗して空の結果になる前に起動時に検出する
+        self.generation_config = generation_types.to_generation_config_dict(GENERATION_CONFIG)
+        self._semaphore = asyncio.Semaphore(GEMINI_CONCURRENCY)
+        self._rate_limiter = AsyncLimiter(max_rate=GEMINI_REQUESTS_PER_MINUTE, time_period=60.0)
+        self.model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+        
+        # 抽出結果のディスクキャッシュ（指定時のみ有効）
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.cache_ttl = cache_ttl
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        
+        # プロセス内の抽出結果キャッシュ（LRU、ディスクキャッシュより先に参照。
+        # ディスクキャッシュと同様に cache_dir 指定時のみ有効）
+        # 値は（抽出日時, 商品のタプル）で、ディスクキャッシュと同じ有効期間で失効する
+        self._memory_cache: OrderedDict[Tuple[str, str], Tuple[datetime, Tuple[Product, ...]]] = OrderedDict()
         
     async def extract_products(self, url: str, site_name: str) -> List[Product]:
         """指定URLからお米商品情報を抽出"""
-        prompt = f"""
-        以下のECサイトのURLから、お米の商品情報を抽出してください。
-        URL: {url}
-        
-        各商品について以下の情報をJSON形式で抽出してください：
-        - name: 商品名（お米の銘柄、容量など）
-        - price: 価格（数値のみ、円単位）
-        - product_url: 商品詳細ページのURL
-        - image_url: 商品画像のURL
-        
-        出力形式：
-        {{
-            "products": [
-                {{
-                    "name": "商品名",
-                    "price": 価格（数値）,
-                    "product_url": "URL",
-                    "image_url": "画像URL"
-                }}
-            ]
-        }}
+        memory_cached = self._memory_cache_get(url, site_name)
+        if memory_cached is not None:
+            logger.info(f"Memory cache hit for {site_name}: {url}")
+            return memory_cached
         
-        注意事項：
-        - お米以外の商品は除外してください
-        - 価格は税込み価格を抽出してください
-        - URLは完全な形式（https://から始まる）で抽出してください
-        """
+        # ファイルI/Oでイベントループを止めないよう、キャッシュの読み書きは別スレッドで行う
+        cached = await asyncio.to_thread(self._load_cache, url, site_name)
+        if cached is not None:
+            logger.info(f"Cache hit for {site_name}: {url}")
+            cached_at, products = cached
+            self._memory_cache_put(url, site_name, products, cached_at)
+            return products
         
         try:
-            # 実際の実装では、ここでウェブページの内容を取得し、
-            # Geminiに渡して解析する処理を行います
-            response = self.model.generate_content(prompt)
+            # 静的な指示を先頭に置き、URLのみを末尾に付加する（暗黙的キャッシュが効くように）
+            prompt = f"{EXTRACTION_PROMPT}\nURL: {url}\n"
             
-            # レスポンスからJSON部分を抽出
-            result_text = response.text
-            json_start = result_text.find('{')
-            json_end = result_text.rfind('}') + 1
-            
-            if json_start != -1 and json_end > json_start:
-                json_str = result_text[json_start:json_end]
-                data = json.loads(json_str)
-                
-                products = []
-                for item in data.get('products', []):
-                    # 商品IDの生成
-                    product_id = self._generate_product_id(site_name, item['product_url'])
-                    
-                    product = Product(
-                        id=product_id,
-                        name=item['name'],
-                        price=item['price'],
-                        product_url=item['product_url'],
-                        image_url=item.get('image_url'),
-                        site_name=site_name
+            # 実際の実装では、ここでウェブページの内容を取得し、
+            # Geminiに渡して解析する処理を行います。
+            # 構造化出力をストリーミングで受信し、受信と並行して連結する
+            for attempt in range(MAX_FEEDBACK_RETRIES + 1):
+                # 同時実行数とリクエストレートを制限してGeminiを呼び出す
+                async with self._semaphore, self._rate_limiter:
+                    response = await self.model.generate_content_async(
+                        prompt,
+                        generation_config=self.generation_config,
+                        stream=True
                     )
-                    products.append(product)
+                    result_text = "".join([chunk.text async for chunk in response])
+                self._log_cache_usage(response)
                 
-                return products
+                # デコードとスキーマ検証を1回で行う
+                try:
+                    data = msgspec.json.decode(result_text, type=ProductsList, strict=False)
+                    break
+                except msgspec.DecodeError as e:
+                    if attempt == MAX_FEEDBACK_RETRIES:
+                        raise
+                    logger.warning(f"Invalid response from Gemini for {url}, retrying: {str(e)}")
+                    # エラー内容をプロンプトに追記して再生成させる
+                    prompt = (
+                        f"{prompt}\n"
+                        f"前回の出力は次の理由でスキーマに適合しませんでした: {str(e)}\n"
+                        f"出力形式に従ったJSONを出力してください。\n"
+                    )
             
-            return []
+            # 商品IDをまとめて生成してから商品情報を組み立てる
+            items = data['products']
+            generate_id = self._generate_product_id
+            ids = [generate_id(site_name, item['product_url']) for item in items]
+            products = [
+                Product(
+                    id=product_id,
+                    name=item['name'],
+                    price=item['price'],
+                    product_url=item['product_url'],
+                    image_url=item.get('image_url'),
+                    site_name=site_name
+                )
+                for product_id, item in zip(ids, items)
+            ]
             
+            await asyncio.to_thread(self._save_cache, url, site_name, products)
+            self._memory_cache_put(url, site_name, products, datetime.now(timezone.utc))
+            return products
+        
         except Exception as e:
             logger.error(f"Error extracting products from {url}: {str(e)}")
             return []
     
-    def _generate_product_id(self, site_name: str, product_url: str) -> str:
-        """商品IDを生成"""
-        hash_input = f"{site_name}_{product_url}"
-        return hashlib.md5(hash_input.encode()).hexdigest()[:16]
+    def _log_cache_usage(self, response):
+        """レスポンスのキャッシュ利用トークン数をログに出力"""
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is not None:
+            logger.debug(
+                f"Gemini tokens: prompt={usage.prompt_token_count}, "
+                f"cached={usage.cached_content_token_count}"
+            )
+    
+    def _memory_cache_get(self, url: str, site_name: str) -> Optional[List[Product]]:
+        """プロセス内キャッシュから抽出結果を取得（呼び出し側には新しいリストを返す）"""
+        if not self.cache_dir:
+            return None
+        
+        key = (url, site_name)
+        entry = self._memory_cache.get(key)
+        if entry is None:
+            return None
+        
+        cached_at, products = entry
+        if datetime.now(timezone.utc) - cached_at > self.cache_ttl:
+            del self._memory_cache[key]
+            return None
+        
+        self._memory_cache.move_to_end(key)
+        return list(products)
+    
+    def _memory_cache_put(self, url: str, site_name: str, products: List[Product], cached_at: datetime):
+        """抽出結果をプロセス内キャッシュに保存し、上限を超えた古いエントリを破棄"""
+        if not self.cache_dir:
+            return
+        
+        key = (url, site_name)
+        self._memory_cache[key] = (cached_at, tuple(products))
+        self._memory_cache.move_to_end(key)
+        while len(self._memory_cache) > MEMORY_CACHE_SIZE:
+            self._memory_cache.popitem(last=False)
+    
+    def _cache_path(self, url: str, site_name: str) -> Path:
+        """モデル・プロンプトバージョン・サイト名・URLからキャッシュファイルのパスを算出"""
+        key_input = b"\0".join([
+            GEMINI_MODEL_NAME.encode(),
+            PROMPT_VERSION.encode(),
+            site_name.encode(),
+            url.encode()
+        ])
+        return self.cache_dir / f"{hashlib.sha256(key_input).hexdigest()}.json"
+    
+    def _load_cache(self, url: str, site_name: str) -> Optional[Tuple[datetime, List[Product]]]:
+        """キャッシュ済みの抽出結果を抽出日時とともに読み込む（スキーマ不一致・期限切れのエントリは削除）"""
+        if not self.cache_dir:
+            return None
+        
+        path = self._cache_path(url, site_name)
+        if not path.exists():
+            return None
+        
+        try:
+            entry = orjson.loads(path.read_bytes())
+            if not isinstance(entry, dict):
+                raise ValueError("entry is not a JSON object")
+            if entry.get('model') != GEMINI_MODEL_NAME or entry.get('prompt_version') != PROMPT_VERSION:
+                raise ValueError("model or prompt version mismatch")
+            cached_at = datetime.fromisoformat(entry['cached_at'])
+            if datetime.now(timezone.utc) - cached_at > self.cache_ttl:
+                raise ValueError(f"expired (cached at {entry['cached_at']})")
+            return cached_at, msgspec.convert(entry['products'], List[Product])
+        except (OSError, ValueError, KeyError, TypeError, msgspec.ValidationError) as e:
+            logger.info(f"Evicting cache entry {path.name}: {str(e)}")
+            try:
+                path.unlink(missing_ok=True)
+            except OSError as unlink_error:
+                logger.warning(f"Failed to evict cache entry {path.name}: {str(unlink_error)}")
+            return None
+    
+    def _save_cache(self, url: str, site_name: str, products: List[Product]):
+        """抽出結果をメタデータとともにキャッシュへ書き込む"""
+        if not self.cache_dir:
+            return
+        
+        entry = {
+            "model": GEMINI_MODEL_NAME,
+            "prompt_version": PROMPT_VERSION,
+            "site_name": site_name,
+            "url": url,
+            "cached_at": datetime.now(timezone.utc).isoformat(),
+            "products": msgspec.to_builtins(products)
+        }
+        
+        try:
+            self._cache_path(url, site_name).write_bytes(orjson.dumps(entry))
+        except OSError as e:
+            logger.warning(f"Failed to write cache for {url}: {str(e)}")
+    
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _generate_product_id(site_name: str, product_url: str) -> str:
+        """商品IDを生成（既存IDとの互換性のため md5("{site_name}_{product_url}") の先頭16桁）"""
+        h = hashlib.md5(site_name.encode())
+        h.update(b"_")
+        h.update(product_url.encode())
+        return h.digest()[:8].hex()
 
 class CloudflareD1Client:
     """Cloudflare D1クライアント"""
@@ -124,59 +336,124 @@ class CloudflareD1Client:
         self.database_id = database_id
         self.api_token = api_token
         self.base_url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/d1/database/{database_id}"
+        self._query_url = f"{self.base_url}/query"
         self.headers = {
             "Authorization": f"Bearer {api_token}",
             "Content-Type": "application/json"
         }
+        
+        # 接続を使い回す非同期セッション（keep-alive + DNSキャッシュ）
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60, ttl_dns_cache=300),
+            timeout=aiohttp.ClientTimeout(total=10)
+        )
     
-    def execute_query(self, query: str, params: List = None) -> Dict:
+    async def close(self):
+        """セッションを閉じて接続プールを解放"""
+        await self.session.close()
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+    
+    async def _post(self, url: str, payload: Dict) -> Dict:
+        """一時的なエラー（接続エラー・429/5xx）を指数バックオフで再試行しながらPOST"""
+        body = orjson.dumps(payload)
+        for attempt in range(MAX_HTTP_RETRIES + 1):
+            is_last_attempt = attempt == MAX_HTTP_RETRIES
+            delay = RETRY_BACKOFF_FACTOR * (2 ** attempt)
+            
+            try:
+                async with self.session.post(url, data=body) as response:
+                    if response.status not in RETRY_STATUS_CODES or is_last_attempt:
+                        response.raise_for_status()
+                        return orjson.loads(await response.read())
+                    
+                    # Retry-Afterヘッダーがあればその秒数だけ待機
+                    retry_after = response.headers.get("Retry-After")
+                    if retry_after and retry_after.isdigit():
+                        delay = int(retry_after)
+                    logger.warning(f"D1 API returned {response.status}, retrying in {delay}s")
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if is_last_attempt:
+                    raise
+                logger.warning(f"D1 API connection failed, retrying in {delay}s: {str(e)}")
+            
+            await asyncio.sleep(delay)
+    
+    async def execute_query(self, query: str, params: List = None) -> Dict:
         """D1データベースにクエリを実行"""
-        url = f"{self.base_url}/query"
-        
         payload = {
             "sql": query,
             "params": params or []
         }
         
-        response = requests.post(url, json=payload, headers=self.headers)
-        response.raise_for_status()
+        return await self._post(self._query_url, payload)
+    
+    async def execute_batch(self, statements: List[Dict]) -> Dict:
+        """複数のステートメントを1回のリクエストでまとめて実行"""
+        payload = {
+            "batch": statements
+        }
         
-        return response.json()
+        return await self._post(self._query_url, payload)
     
-    def upsert_product(self, product: Product) -> bool:
+    async def upsert_product(self, product: Product) -> bool:
         """商品情報をアップサート"""
-        query = """
-        INSERT INTO products (
-            id, name, price, product_url, affiliate_url, 
-            image_url, site_name, last_scraped_at, created_at, updated_at
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-        ON CONFLICT(id) DO UPDATE SET
-            name = excluded.name,
-            price = excluded.price,
-            affiliate_url = excluded.affiliate_url,
-            image_url = excluded.image_url,
-            last_scraped_at = CURRENT_TIMESTAMP,
-            updated_at = CURRENT_TIMESTAMP
-        """
+        return await self.upsert_products([product]) == 1
+    
+    async def upsert_products(self, products: List[Product]) -> int:
+        """複数の商品情報をUPSERT_BATCH_SIZE件ずつバッチでアップサートし、成功件数を返す
         
-        params = [
-            product.id,
-            product.name,
-            product.price,
-            product.product_url,
-            product.affiliate_url,
-            product.image_url,
-            product.site_name
+        D1はバッチを1トランザクションとして実行するため、失敗の影響がバッチ内に留まるよう分割する
+        """
+        success_count = 0
+        for start in range(0, len(products), UPSERT_BATCH_SIZE):
+            success_count += await self._upsert_batch(products[start:start + UPSERT_BATCH_SIZE])
+        return success_count
+    
+    async def _upsert_batch(self, products: List[Product]) -> int:
+        """1回のバッチリクエストで商品情報をアップサートし、成功件数を返す"""
+        statements = [
+            {
+                "sql": _UPSERT_SQL,
+                "params": [
+                    product.id,
+                    product.name,
+                    product.price,
+                    product.product_url,
+                    product.affiliate_url,
+                    product.image_url,
+                    product.site_name
+                ]
+            }
+            for product in products
         ]
         
         try:
-            self.execute_query(query, params)
-            return True
+            results = (await self.execute_batch(statements)).get('result') or []
         except Exception as e:
-            logger.error(f"Error upserting product {product.id}: {str(e)}")
-            return False
+            logger.error(f"Error upserting batch of {len(products)} products: {str(e)}")
+            results = []
+        
+        # 成功した結果が返らなかった商品はすべて失敗としてログに出力
+        success_count = 0
+        for index, product in enumerate(products):
+            statement_result = results[index] if index < len(results) else None
+            if isinstance(statement_result, dict) and statement_result.get('success', False):
+                success_count += 1
+            else:
+                logger.error(
+                    f"Error upserting product {product.id} ({product.product_url}): "
+                    f"{statement_result or 'no result returned'}"
+                )
+        
+        return success_count
 
-async def main():
+async def main(cache_dir: Optional[str] = None, cache_ttl: timedelta = EXTRACTION_CACHE_TTL):
     """メイン処理"""
     # 環境変数から設定を読み込み
     gemini_api_key = os.getenv("GEMINI_API_KEY")
@@ -201,25 +478,44 @@ async def main():
     ]
     
     # クライアントの初期化
-    scraper = GeminiScraper(gemini_api_key)
-    d1_client = CloudflareD1Client(cf_account_id, cf_database_id, cf_api_token)
-    
-    # 各サイトから商品情報を取得
-    for site in target_sites:
+    scraper = GeminiScraper(gemini_api_key, cache_dir=cache_dir, cache_ttl=cache_ttl)
+    async def scrape_site(site: Dict) -> List[Product]:
         logger.info(f"Scraping {site['name']}...")
-        products = await scraper.extract_products(site['url'], site['name'])
-        
-        logger.info(f"Found {len(products)} products from {site['name']}")
-        
-        # D1に保存
-        success_count = 0
-        for product in products:
-            if d1_client.upsert_product(product):
-                success_count += 1
-        
-        logger.info(f"Saved {success_count}/{len(products)} products from {site['name']}")
+        return await scraper.extract_products(site['url'], site['name'])
+    
+    # 各サイトから商品情報を並行して取得
+    results = await asyncio.gather(
+        *(scrape_site(site) for site in target_sites),
+        return_exceptions=True
+    )
+    
+    # D1に保存（サイトごとにバッチでアップサートし、失敗が他サイトに波及しないようにする）
+    async with CloudflareD1Client(cf_account_id, cf_database_id, cf_api_token) as d1_client:
+        for site, products in zip(target_sites, results):
+            if isinstance(products, BaseException):
+                logger.error(f"Error scraping {site['name']}: {str(products)}")
+                continue
+            
+            logger.info(f"Found {len(products)} products from {site['name']}")
+            
+            success_count = await d1_client.upsert_products(products)
+            
+            logger.info(f"Saved {success_count}/{len(products)} products from {site['name']}")
     
     logger.info("Scraping completed")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="お米商品情報スクレイピング")
+    parser.add_argument(
+        "--cache-dir",
+        help="Geminiの抽出結果をキャッシュするディレクトリ（未指定時はキャッシュしない）"
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=int,
+        default=int(EXTRACTION_CACHE_TTL.total_seconds()),
+        help="キャッシュの有効期間（秒）。これより古いエントリは破棄してGeminiから再取得する"
+    )
+    args = parser.parse_args()
+    
+    asyncio.run(main(cache_dir=args.cache_dir, cache_ttl=timedelta(seconds=args.cache_ttl)))
\ No newline at end of file
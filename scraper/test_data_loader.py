@@ -4,16 +4,34 @@
 """
 
 import os
-import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Final
 import hashlib
+from functools import lru_cache
 from dotenv import load_dotenv
 
 # 環境変数の読み込み
 load_dotenv()
 
+# 商品情報のアップサート文
+_UPSERT_SQL: Final[str] = """
+INSERT INTO products (
+    id, name, price, product_url, affiliate_url, 
+    image_url, site_name, last_scraped_at, created_at, updated_at
+) VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+ON CONFLICT(id) DO UPDATE SET
+    name = excluded.name,
+    price = excluded.price,
+    affiliate_url = excluded.affiliate_url,
+    image_url = excluded.image_url,
+    last_scraped_at = CURRENT_TIMESTAMP,
+    updated_at = CURRENT_TIMESTAMP
+"""
+
 class CloudflareD1Client:
     """Cloudflare D1クライアント"""
     
@@ -22,49 +40,80 @@ class CloudflareD1Client:
         self.database_id = database_id
         self.api_token = api_token
         self.base_url = f"https://api.cloudflare.com/client/v4/accounts/{account_id}/d1/database/{database_id}"
+        self._query_url = f"{self.base_url}/query"
         self.headers = {
             "Authorization": f"Bearer {api_token}",
             "Content-Type": "application/json"
         }
+        
+        # 接続を使い回すためのセッション（keep-alive + リトライ）
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        retry = Retry(
+            total=3,
+            backoff_factor=1.0,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["POST"],
+            respect_retry_after_header=True,
+            # 再試行を使い切った場合もレスポンスを返し、raise_for_status でエラー本文を参照できるようにする
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=32, max_retries=retry)
+        self.session.mount("https://", adapter)
+    
+    def close(self):
+        """セッションを閉じて接続プールを解放"""
+        self.session.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
     
     def execute_query(self, query: str, params: List = None) -> Dict:
         """D1データベースにクエリを実行"""
-        url = f"{self.base_url}/query"
-        
         payload = {
             "sql": query,
             "params": params or []
         }
         
         try:
-            response = requests.post(url, json=payload, headers=self.headers)
+            response = self.session.post(self._query_url, data=orjson.dumps(payload))
             response.raise_for_status()
-            return response.json()
+            return orjson.loads(response.content)
         except requests.exceptions.RequestException as e:
             print(f"Error executing query: {e}")
             if hasattr(e, 'response') and e.response is not None:
                 print(f"Response: {e.response.text}")
             raise
+    
+    def execute_batch(self, statements: List[Dict]) -> Dict:
+        """複数のステートメントを1回のリクエストでまとめて実行"""
+        payload = {
+            "batch": statements
+        }
+        
+        try:
+            response = self.session.post(self._query_url, data=orjson.dumps(payload))
+            response.raise_for_status()
+            return orjson.loads(response.content)
+        except requests.exceptions.RequestException as e:
+            print(f"Error executing batch: {e}")
+            if hasattr(e, 'response') and e.response is not None:
+                print(f"Response: {e.response.text}")
+            raise
 
+@lru_cache(maxsize=4096)
 def generate_product_id(site_name: str, product_url: str) -> str:
-    """商品IDを生成"""
-    hash_input = f"{site_name}_{product_url}"
-    return hashlib.md5(hash_input.encode()).hexdigest()[:16]
+    """商品IDを生成（既存IDとの互換性のため md5("{site_name}_{product_url}") の先頭16桁）"""
+    h = hashlib.md5(site_name.encode())
+    h.update(b"_")
+    h.update(product_url.encode())
+    return h.digest()[:8].hex()
 
-def main():
-    """テストデータを登録"""
-    # 環境変数から設定を読み込み
-    cf_account_id = os.getenv("CF_ACCOUNT_ID")
-    cf_database_id = os.getenv("CF_DATABASE_ID")
-    cf_api_token = os.getenv("CF_API_TOKEN")
-    
-    if not all([cf_account_id, cf_database_id, cf_api_token]):
-        print("必要な環境変数が設定されていません")
-        return
-    
-    # D1クライアントの初期化
-    d1_client = CloudflareD1Client(cf_account_id, cf_database_id, cf_api_token)
-    
+def load_test_products(d1_client: CloudflareD1Client):
+    """テスト用の商品データをD1に登録"""
     # テスト用のお米商品データ
     test_products = [
         {
@@ -117,43 +166,37 @@ def main():
         }
     ]
     
-    # 各商品をD1に登録
+    statements = [
+        {
+            "sql": _UPSERT_SQL,
+            "params": [
+                generate_product_id(product["site_name"], product["product_url"]),
+                product["name"],
+                product["price"],
+                product["product_url"],
+                product["affiliate_url"],
+                product["image_url"],
+                product["site_name"]
+            ]
+        }
+        for product in test_products
+    ]
+    
+    # 全商品を1回のバッチリクエストでD1に登録
+    try:
+        results = d1_client.execute_batch(statements).get('result', [])
+    except Exception as e:
+        print(f"❌ 一括登録失敗: エラー: {str(e)}")
+        results = []
+    
     success_count = 0
-    for product in test_products:
-        # 商品IDの生成
-        product_id = generate_product_id(product["site_name"], product["product_url"])
-        
-        # INSERT文の実行
-        query = """
-        INSERT INTO products (
-            id, name, price, product_url, affiliate_url, 
-            image_url, site_name, last_scraped_at, created_at, updated_at
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-        ON CONFLICT(id) DO UPDATE SET
-            name = excluded.name,
-            price = excluded.price,
-            affiliate_url = excluded.affiliate_url,
-            image_url = excluded.image_url,
-            last_scraped_at = CURRENT_TIMESTAMP,
-            updated_at = CURRENT_TIMESTAMP
-        """
-        
-        params = [
-            product_id,
-            product["name"],
-            product["price"],
-            product["product_url"],
-            product["affiliate_url"],
-            product["image_url"],
-            product["site_name"]
-        ]
-        
-        try:
-            result = d1_client.execute_query(query, params)
+    for index, product in enumerate(test_products):
+        statement_result = results[index] if index < len(results) else None
+        if statement_result and statement_result.get('success', False):
             print(f"✅ 登録成功: {product['name']} - ¥{product['price']:,}")
             success_count += 1
-        except Exception as e:
-            print(f"❌ 登録失敗: {product['name']} - エラー: {str(e)}")
+        else:
+            print(f"❌ 登録失敗: {product['name']} - エラー: {statement_result}")
     
     print(f"\n合計: {success_count}/{len(test_products)} 件の商品を登録しました")
     
@@ -165,5 +208,20 @@ def main():
     except Exception as e:
         print(f"データ数の確認に失敗: {str(e)}")
 
+def main():
+    """テストデータを登録"""
+    # 環境変数から設定を読み込み
+    cf_account_id = os.getenv("CF_ACCOUNT_ID")
+    cf_database_id = os.getenv("CF_DATABASE_ID")
+    cf_api_token = os.getenv("CF_API_TOKEN")
+    
+    if not all([cf_account_id, cf_database_id, cf_api_token]):
+        print("必要な環境変数が設定されていません")
+        return
+    
+    # D1クライアントの初期化
+    with CloudflareD1Client(cf_account_id, cf_database_id, cf_api_token) as d1_client:
+        load_test_products(d1_client)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file